@@ -1,92 +1,470 @@
+import numpy as np
 import pandas as pd
 import os
+import pickle
+import re
+import tempfile
 import argparse
-from jinja2 import FileSystemLoader, Environment
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from html import escape
+from jinja2 import ChoiceLoader, FileSystemLoader, FileSystemBytecodeCache, Environment, ModuleLoader, TemplateNotFound
 
 # Allow for very wide columns - otherwise columns are spaced and ellipse'd
 pd.set_option("display.max_colwidth", 200)
 
+# Known column types for reading the statistics, so pandas can skip type inference.
+# The nullable "boolean" type keeps a blank "correct" cell as missing rather than failing or reading it as False.
+STATISTICS_DTYPES = {"correct": "boolean"}
+
+# Statistics held by ModelResults and cached beside each results file
+STATISTICS_KEYS = frozenset(["number_of_images", "accuracy", "misidentified_images", "number_misidentified"])
+
+# Number of table rows converted to HTML at a time when streaming the report
+HTML_CHUNK_SIZE = 5000
+
+# Control characters that DataFrame.to_html writes out as escape sequences in cell text
+HTML_CONTROL_CHARACTERS = str.maketrans({"\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+# Matches the model name and filename at the end of a results filepath '<model_name>_results.csv'
+RESULTS_FILENAME_PATTERN = re.compile(r"([^/\\]+?)_results\.csv$")
+
+
+class PrecompiledLoader(ModuleLoader):
+    """
+    Loader for templates precompiled by compile_templates.py, which ignores any compiled template older than its
+    source so that edits to the templates are never hidden.
+    """
+
+    def __init__(self, path, source_path):
+        """
+        :param path: Folder holding the compiled templates.
+        :param source_path: Folder holding the template sources.
+        """
+        super().__init__(path)
+        self.path = path
+        self.source_path = source_path
+
+    def load(self, environment, name, globals=None):
+        """
+        Load a compiled template, raising TemplateNotFound if it is missing or out of date.
+        """
+        source_filepath = os.path.join(self.source_path, name)
+        compiled_filepath = os.path.join(self.path, self.get_module_filename(name))
+        if not os.path.exists(source_filepath) or not is_cache_fresh(compiled_filepath, source_filepath):
+            raise TemplateNotFound(name)
+        return super().load(environment, name, globals)
+
 
 class ModelResults:
     """
     Class to store the results of a model run and associated data.
+    Only summary statistics are held; the results DataFrame is read again when its table is rendered.
     """
 
-    def __init__(self, model_name, filepath):
+    __slots__ = (
+        "model_name", "filepath", "dataset",
+        "number_of_images", "accuracy", "misidentified_images", "number_misidentified"
+    )
+
+    def __init__(self, model_name, filepath, dataset=None):
         """
         :param model_name: Name of model.
         :param filepath: Filepath to results .csv.
+        :param dataset: Filename of the results .csv. Taken from the filepath if None.
         """
         self.model_name = model_name
         self.filepath = filepath
 
-        self.dataset = os.path.split(filepath)[-1]
-        self.df_results = csv_to_df(filepath)  # Filesystem access
-
-        self.number_of_images = len(self.df_results)
-
-        self.accuracy = self._calculate_accuracy()
+        self.dataset = dataset if dataset is not None else os.path.basename(filepath)
+        statistics = self._load_statistics()
+        self.number_of_images = statistics["number_of_images"]
+        self.accuracy = statistics["accuracy"]
+        self.misidentified_images = statistics["misidentified_images"]
+        self.number_misidentified = statistics["number_misidentified"]
 
-        self.misidentified_images = self._get_misidentified_images()
-        self.number_misidentified = len(self.misidentified_images)
+    @property
+    def misidentified_images_list(self):
+        """
+        Return the misidentified image names as a list.
+        :return: List of strings of misidentified image filenames.
+        """
+        return self.misidentified_images.tolist()
 
-    def _calculate_accuracy(self):
+    def _load_statistics(self):
         """
-        Return the accuracy for the dataset.
-        :return: Float of dataset accuracy [0..1].
+        Return the statistics for the dataset, from the cache beside the results file if it is up to date.
+        :return: Dictionary of statistic attribute names and values.
         """
-        number_correct = len(self.df_results[self.df_results["correct"] == True])
-        number_total = len(self.df_results)
-        return number_correct / number_total
+        statistics_filepath = self.filepath + ".stats.pkl"
+        signature = get_file_signature(self.filepath)
+        statistics = read_cache(statistics_filepath, signature)
+        # Caches written by older versions may not hold every statistic
+        if isinstance(statistics, dict) and STATISTICS_KEYS.issubset(statistics):
+            return statistics
 
-    def _get_misidentified_images(self):
+        statistics = self._calculate_statistics()
+        write_cache(statistics, statistics_filepath, signature)
+        return statistics
+
+    def _calculate_statistics(self):
         """
-        Return the names misidentified images.
-        :return: List of strings of misidentified image filenames.
+        Read the results file and calculate the statistics for the dataset.
+        :return: Dictionary of statistic attribute names and values.
         """
-        df_misidentified = self.df_results[self.df_results["correct"] == False]
-        misidentified_images = df_misidentified.index.tolist()
-        return misidentified_images
+        # Only the "correct" column is needed for the statistics; the full table is read when rendered
+        df_results = csv_to_df(self.filepath, columns=["correct"])  # Filesystem access
+
+        # A blank "correct" cell counts as neither correct nor misidentified
+        correct = df_results["correct"]
+        is_correct = correct.eq(True).fillna(False).to_numpy(dtype=bool)
+        is_misidentified = correct.eq(False).fillna(False).to_numpy(dtype=bool)
+        number_of_images = correct.size
+
+        return {
+            "number_of_images": number_of_images,
+            "accuracy": np.count_nonzero(is_correct) / number_of_images,
+            "misidentified_images": np.sort(df_results.index.to_numpy()[is_misidentified]),
+            "number_misidentified": np.count_nonzero(is_misidentified),
+        }
 
     def get_results_df_as_html(self):
         """
         Return the results DataFrame as an HTML object.
         :return: String of HTML.
         """
-        html = self.df_results.to_html(table_id=self.model_name)
+        html = "".join(self.iter_results_df_as_html())
         return html
 
+    def iter_results_df_as_html(self, chunk_size=HTML_CHUNK_SIZE):
+        """
+        Yield the results DataFrame as HTML, a chunk of rows at a time.
+        :param chunk_size: Number of table rows in each chunk.
+        :return: Generator of strings of HTML.
+        """
+        df_results = csv_to_df(self.filepath)  # Filesystem access
+        yield from iter_df_as_html(df_results, table_id=self.model_name, chunk_size=chunk_size)
+
 
-def csv_to_df(filepath):
+def csv_to_df(filepath, columns=None):
     """
     Open a .csv file and return it in DataFrame format.
     :param filepath: Filepath to a .csv file to be read.
+    :param columns: Optional list of column names to read alongside the index. Reads all columns if None.
     :return: .csv file in DataFrame format.
     """
-    df = pd.read_csv(filepath, index_col=0)
+    # Full reads are cached beside the .csv file and reused while the .csv is unchanged
+    cache_filepath = filepath + ".pkl"
+    signature = get_file_signature(filepath)
+    if columns is None:
+        df = read_cache(cache_filepath, signature)
+        if isinstance(df, pd.DataFrame):
+            return df
+
+    # The index is always the first column, whatever its header says (it is blank when written by to_csv)
+    names, positions = None, None
+    if columns is not None:
+        with open(filepath, newline="") as f:
+            header = next(csv.reader(f))
+        positions = [0] + [header.index(column) for column in columns]
+        names = [header[position] for position in positions]
+    # Only the statistics read has known types; the full table is inferred, as it is displayed as read
+    dtype = STATISTICS_DTYPES if columns is not None else None
+    try:
+        # The pyarrow engine parses with multiple threads, but is an optional dependency
+        df = pd.read_csv(filepath, index_col=0, usecols=names, dtype=dtype, engine="pyarrow")
+        # Match the C engine, which leaves a blank index header unnamed, and reads missing values in
+        # mixed columns (e.g. booleans with a blank cell) as NaN rather than None
+        if df.index.name == "":
+            df.index.name = None
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].where(df[column].notna(), np.nan)
+    except (ImportError, ValueError, KeyError):
+        df = pd.read_csv(filepath, index_col=0, usecols=positions, dtype=dtype, engine="c")
+
+    if columns is None:
+        write_cache(df, cache_filepath, signature)
     return df
 
 
+def is_cache_fresh(cache_filepath, source_filepath):
+    """
+    Check whether a cache file exists and is at least as new as the file it was derived from.
+    :param cache_filepath: Filepath to the cache file.
+    :param source_filepath: Filepath to the file the cache was derived from.
+    :return: True if the cache can be used.
+    """
+    return os.path.exists(cache_filepath) and os.path.getmtime(cache_filepath) >= os.path.getmtime(source_filepath)
+
+
+def get_file_signature(filepath):
+    """
+    Return the modification time and size of a file, which caches derived from it are keyed on.
+    :param filepath: Filepath to the file.
+    :return: Tuple of the modification time in nanoseconds and the size in bytes.
+    """
+    stat = os.stat(filepath)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_cache(cache_filepath, signature):
+    """
+    Return the object pickled in a cache file, if the cache can be read and was derived from the same source.
+    :param cache_filepath: Filepath to the cache file.
+    :param signature: Signature of the source file, as per get_file_signature.
+    :return: The cached object, or None if there is no usable cache.
+    """
+    try:
+        with open(cache_filepath, "rb") as f:
+            cache = pickle.load(f)
+    except Exception:
+        return None  # A missing, corrupt or unreadable cache is treated as missing
+
+    # A source replaced by an older or different file won't match, even if it is older than the cache
+    if not isinstance(cache, tuple) or len(cache) != 2 or cache[0] != signature:
+        return None
+    return cache[1]
+
+
+def write_cache(obj, cache_filepath, signature):
+    """
+    Pickle an object to a cache file, writing to a temporary file first and moving it into place,
+    so that a partly written cache is never read. Caching is best-effort, so failures are ignored.
+    :param obj: Object to be cached.
+    :param cache_filepath: Filepath to the cache file.
+    :param signature: Signature of the source file the object was derived from, as per get_file_signature.
+    """
+    try:
+        fd, temp_filepath = tempfile.mkstemp(
+            dir=os.path.dirname(cache_filepath) or ".", prefix=os.path.basename(cache_filepath) + ".",
+            suffix=".tmp.pkl")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((signature, obj), f)
+        os.replace(temp_filepath, cache_filepath)
+    except Exception:
+        try:
+            os.remove(temp_filepath)
+        except OSError:
+            pass
+
+
+def is_report_up_to_date(report_filepath, results_filepaths):
+    """
+    Check whether a report was written from the same results files and is newer than all of its inputs.
+    Inputs are the results files, the templates (including any precompiled ones) and this script.
+    :param report_filepath: Filepath to the report.
+    :param results_filepaths: List of filepaths to the results files the report is to be produced from.
+    :return: True if the report doesn't need writing again.
+    """
+    # The report's inputs are recorded beside it, so a different selection of results files is caught
+    inputs_filepath = report_filepath + ".inputs"
+    if not os.path.exists(report_filepath) or not os.path.exists(inputs_filepath):
+        return False
+    with open(inputs_filepath) as f:
+        if f.read() != "\n".join(results_filepaths):
+            return False
+
+    # Precompiled templates are rendered in place of their sources, so they count as inputs too
+    template_filepaths = [os.path.join("templates", name) for name in os.listdir("templates")]
+    if os.path.isdir("templates_compiled"):
+        template_filepaths += [os.path.join("templates_compiled", name) for name in os.listdir("templates_compiled")]
+    source_filepaths = list(results_filepaths) + template_filepaths + [os.path.abspath(__file__)]
+    source_mtime = max(os.path.getmtime(filepath) for filepath in source_filepaths)
+    return os.path.getmtime(report_filepath) >= source_mtime
+
+
+def build_model_results(results_filepath):
+    """
+    Derive the model name from a results filepath and load its ModelResults.
+    :param results_filepath: Filepath to a results file named '<model_name>_results.csv'.
+    :return: ModelResults object.
+    """
+    match = RESULTS_FILENAME_PATTERN.search(results_filepath)
+    if match is None:
+        # Not named as expected, so fall back to taking the model name from the bare filename
+        results_root_name = os.path.splitext(os.path.basename(results_filepath))[0]
+        return ModelResults(results_root_name.split("_results")[0], results_filepath)
+    return ModelResults(match.group(1), results_filepath, dataset=match.group(0))
+
+
+def _html_text(value):
+    """
+    Return a value as the text of an HTML body cell, escaped and stripped as per DataFrame.to_html.
+    Header cells are only escaped and stripped, as DataFrame.to_html leaves their tabs and line breaks as they are.
+    :param value: Cell value.
+    :return: String of HTML-escaped text, with tabs and line breaks written as "\\t", "\\n" and "\\r".
+    """
+    text = str(value).translate(HTML_CONTROL_CHARACTERS)
+    return escape(text, quote=False).strip()
+
+
+def _can_format_as_html_cells(values):
+    """
+    Check whether a column can be converted by _html_cells and still match DataFrame.to_html.
+    :param values: Series or Index of cell values.
+    :return: True if the values are booleans, integers or strings, with none missing.
+    """
+    if values.isna().any():
+        return False
+    return values.dtype.kind in "biu" or pd.api.types.is_string_dtype(values.dtype)
+
+
+def _html_cells(values, tag):
+    """
+    Wrap every value of an array in an HTML cell, as a vectorised string operation.
+    Results files have a known schema, so boolean and integer columns take faster dtype-specific paths.
+    :param values: Array of boolean, integer or string cell values.
+    :param tag: Cell tag to use, e.g. "td" or "th".
+    :return: Array of strings of HTML cells.
+    """
+    open_tag, close_tag = "      <{}>".format(tag), "</{}>\n".format(tag)
+    if values.dtype.kind == "b":
+        # Only two cells are possible, e.g. the "correct" column, so pick between them
+        return np.where(values, open_tag + "True" + close_tag, open_tag + "False" + close_tag)
+
+    if values.dtype.kind in "iu":
+        # Integers format without padding or markup, so need no stripping or escaping
+        text = values.astype(str)
+    else:
+        text = np.array([_html_text(value) for value in values.astype(str).tolist()], dtype=str)
+    return np.char.add(np.char.add(open_tag, text), close_tag)
+
+
+def _pandas_html_cells(values, tag):
+    """
+    Wrap every value of a column or index in an HTML cell, formatted by DataFrame.to_html.
+    Used where _html_cells can't match pandas, e.g. floats, whose format pandas chooses across the whole column.
+    :param values: Series or Index of cell values.
+    :param tag: Cell tag to use, "td" for a column or "th" for an index.
+    :return: Array of strings of HTML cells.
+    """
+    if tag == "th":
+        html = pd.DataFrame(index=values).to_html()
+    else:
+        html = pd.Series(values).reset_index(drop=True).to_frame().to_html(header=False, index=False)
+    body = html[html.index("<tbody>"):]
+    texts = re.findall(r"<{0}>(.*?)</{0}>".format(tag), body, flags=re.S)
+    open_tag, close_tag = "      <{}>".format(tag), "</{}>\n".format(tag)
+    return np.char.add(np.char.add(open_tag, np.array(texts, dtype=str)), close_tag)
+
+
+def df_to_html(df, table_id):
+    """
+    Return a DataFrame as an HTML table, matching DataFrame.to_html.
+    :param df: DataFrame to be converted.
+    :param table_id: id attribute of the table.
+    :return: String of HTML.
+    """
+    return "".join(iter_df_as_html(df, table_id))
+
+
+def iter_df_as_html(df, table_id, chunk_size=HTML_CHUNK_SIZE):
+    """
+    Yield a DataFrame as an HTML table, matching DataFrame.to_html, a chunk of rows at a time.
+    Boolean, integer and string cells are built column-wise with NumPy string operations, a chunk at a time.
+    Other columns, such as floats or those with missing values, are formatted whole by pandas up front and then
+    sliced into the same chunks. Tables with multi-level headers or indexes are left to DataFrame.to_html.
+    :param df: DataFrame to be converted.
+    :param table_id: id attribute of the table.
+    :param chunk_size: Number of table rows in each chunk.
+    :return: Generator of strings of HTML.
+    """
+    if isinstance(df.index, pd.MultiIndex) or isinstance(df.columns, pd.MultiIndex):
+        yield df.to_html(table_id=table_id)
+        return
+
+    html = ['<table border="1" class="dataframe" id="{}">\n'.format(table_id), "  <thead>\n"]
+    html.append('    <tr style="text-align: right;">\n      <th></th>\n')
+    html.extend("      <th>{}</th>\n".format(escape(str(column).strip(), quote=False)) for column in df.columns)
+    html.append("    </tr>\n")
+    if df.index.name is not None:
+        html.append("    <tr>\n      <th>{}</th>\n".format(escape(str(df.index.name).strip(), quote=False)))
+        html.append("      <th></th>\n" * len(df.columns))
+        html.append("    </tr>\n")
+    html.append("  </thead>\n  <tbody>\n")
+    yield "".join(html)
+
+    if not len(df):
+        yield "  </tbody>\n</table>"
+        return
+
+    # Cells only pandas can format to match are formatted once for the whole table; None marks the rest
+    index_cells = None if _can_format_as_html_cells(df.index) else _pandas_html_cells(df.index, "th")
+    column_cells = [
+        None if _can_format_as_html_cells(df.iloc[:, position]) else _pandas_html_cells(df.iloc[:, position], "td")
+        for position in range(len(df.columns))
+    ]
+
+    for start in range(0, len(df), chunk_size):
+        stop = start + chunk_size
+        df_chunk = df.iloc[start:stop]
+        rows = _html_cells(df_chunk.index.to_numpy(), "th") if index_cells is None else index_cells[start:stop]
+        for position, cells in enumerate(column_cells):
+            if cells is None:
+                cells = _html_cells(df_chunk.iloc[:, position].to_numpy(), "td")
+            else:
+                cells = cells[start:stop]
+            rows = np.char.add(rows, cells)
+        rows = np.char.add(np.char.add("    <tr>\n", rows), "    </tr>\n")
+        yield "".join(rows.tolist())
+
+    yield "  </tbody>\n</table>"
+
+
 def common_misidentified_images(list_model_results):
     """
-    For a collection of ModelResults objects, return a list of images names that were misidentified by all.
+    For a collection of ModelResults objects, return the images names that were misidentified by all.
     :param list_model_results: List of ModelResults objects.
-    :return: List of common misidentified image names.
+    :return: Sorted array of common misidentified image names.
     """
-    misidentified_images_sets = [set(model_results.misidentified_images) for model_results in list_model_results]
-    common_images = set.intersection(*misidentified_images_sets)
+    # Nothing can be common if there are no models or any model misidentified nothing
+    if not list_model_results or min(model_results.number_misidentified for model_results in list_model_results) == 0:
+        return np.array([], dtype=object)
+
+    # Intersect from the smallest array up, stopping as soon as nothing is left in common
+    misidentified_images_arrays = sorted(
+        (model_results.misidentified_images for model_results in list_model_results), key=len)
+    # Copied, so that changes to the result don't reach the ModelResults it came from
+    common_images = misidentified_images_arrays[0].copy()
+    for misidentified_images in misidentified_images_arrays[1:]:
+        common_images = np.intersect1d(common_images, misidentified_images)
+        if not common_images.size:
+            break
     return common_images
 
 
-# Configure Jinja and ready the loader
-env = Environment(
-    loader=FileSystemLoader(searchpath="templates")
-)
+@lru_cache(maxsize=None)
+def get_environment():
+    """
+    Return the Jinja environment, configuring it on first use so that it and its template cache are shared.
+    Templates precompiled by compile_templates.py are preferred while they are up to date, falling back to the
+    template sources.
+    Compiled sources are also cached to disk so later runs skip the parse/compile step.
+    :return: Jinja Environment object.
+    """
+    os.makedirs(".jinja_cache", exist_ok=True)
+    return Environment(
+        loader=ChoiceLoader([
+            PrecompiledLoader("templates_compiled", source_path="templates"),
+            FileSystemLoader(searchpath="templates")
+        ]),
+        bytecode_cache=FileSystemBytecodeCache(directory=".jinja_cache", pattern="__jinja2_%s.cache"),
+        auto_reload=False
+    )
+
 
-# Assemble the templates we'll use
-base_template = env.get_template("report.html")
-summary_section_template = env.get_template("summary_section.html")
-table_section_template = env.get_template("table_section.html")
+@lru_cache(maxsize=None)
+def get_template(name):
+    """
+    Return a template from the environment, loading it on first use.
+    :param name: Filename of the template within the templates folder.
+    :return: Jinja Template object.
+    """
+    return get_environment().get_template(name)
 
 
 def main():
@@ -102,41 +480,65 @@ def main():
         nargs="+",
         help="Path(s) to results file(s) with filename(s) '<model_name>_results.csv'."
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Write the report even if it is already up to date."
+    )
     args = parser.parse_args()
 
+    # Skip the work entirely if the report was already produced from these unchanged inputs
+    report_filepath = "outputs/report.html"
+    if not args.force and is_report_up_to_date(report_filepath, args.results_filepaths):
+        print('"report.html" in folder "outputs" is already up to date.')
+        return
+
+    # Assemble the templates we'll use
+    base_template = get_template("report.html")
+    summary_section_template = get_template("summary_section.html")
+    table_section_template = get_template("table_section.html")
+
     # Create the model_results list, which holds the relevant information
-    model_results = []
-    for results_filepath in args.results_filepaths:
-        results_root_name = os.path.splitext(os.path.basename(results_filepath))[0]
-        model_name = results_root_name.split("_results")[0]
-        model_results.append(
-            ModelResults(model_name, results_filepath))
+    # Each results file is independent, so load them concurrently
+    with ThreadPoolExecutor() as executor:
+        model_results = list(executor.map(build_model_results, args.results_filepaths))
 
     # Create some more content to be published as part of this analysis
     title = "Model Report"
-    misidentified_images = [set(results.misidentified_images) for results in model_results]
-    number_misidentified = len(set.intersection(*misidentified_images))
+    number_misidentified = common_misidentified_images(model_results).size
 
     # Produce our section blocks
+    # Sections are generated lazily, so each table is only read and converted as the report is written
     sections = list()
-    sections.append(summary_section_template.render(
+    sections.append(summary_section_template.generate(
         model_results_list=model_results,
         number_misidentified=number_misidentified
     ))
     for model_result in model_results:
-        sections.append(table_section_template.render(
-            model=model_result.model_name,
-            dataset=model_result.dataset,
-            table=model_result.get_results_df_as_html())
-        )
+        sections.append(table_section_template.generate(result=model_result))
 
     # Produce and write the report to file
-    with open("outputs/report.html", "w") as f:
-        f.write(base_template.render(
-            title=title,
-            sections=sections,
-            model_results_list=model_results
-        ))
+    # Stream the report to file rather than building the whole document in memory,
+    # encoding once and writing through a large buffer to keep the number of writes down
+    # The report is written to a temporary file and moved into place once complete, and its inputs are only
+    # recorded after that, so an interrupted run never leaves a partial report that looks up to date
+    inputs_filepath = report_filepath + ".inputs"
+    if os.path.exists(inputs_filepath):
+        os.remove(inputs_filepath)
+    temp_filepath = report_filepath + ".tmp"
+    try:
+        with open(temp_filepath, "wb", buffering=1 << 20) as f:
+            base_template.stream(
+                title=title,
+                sections=sections,
+                model_results_list=model_results
+            ).dump(f, encoding="utf-8")
+        os.replace(temp_filepath, report_filepath)
+    finally:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+    with open(inputs_filepath, "w") as f:
+        f.write("\n".join(args.results_filepaths))
     print('Successfully wrote "report.html" to folder "outputs".')
 
 
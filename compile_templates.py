@@ -0,0 +1,26 @@
+import argparse
+from jinja2 import FileSystemLoader, Environment
+
+
+def main():
+    """
+    Entry point for the script.
+    Precompile the report templates to Python modules, to be loaded by autoreporting.py.
+    Re-run this whenever a template is changed.
+    :return:
+    """
+    parser = argparse.ArgumentParser(description="Precompile the report templates to Python modules.")
+    parser.add_argument(
+        "--target",
+        default="templates_compiled",
+        help="Folder to write the compiled templates to."
+    )
+    args = parser.parse_args()
+
+    env = Environment(loader=FileSystemLoader(searchpath="templates"))
+    env.compile_templates(args.target, zip=None)
+    print('Successfully compiled templates to folder "{}".'.format(args.target))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from jinja2 import ChoiceLoader, Environment, FileSystemLoader
+
+import autoreporting
+
+
+def copy_dataset(filename, folder):
+    """
+    Copy a sample dataset into a folder, so that caches written beside it stay out of the working tree.
+    :return: Filepath to the copy.
+    """
+    filepath = str(folder / filename)
+    with open(os.path.join("datasets", filename), "rb") as source, open(filepath, "wb") as f:
+        f.write(source.read())
+    return filepath
+
+
+@pytest.fixture(params=["pyarrow", "c"])
+def csv_engine(request, monkeypatch):
+    """
+    Read results files with each pandas engine in turn, making pyarrow unavailable for the C engine.
+    """
+    if request.param == "pyarrow":
+        pytest.importorskip("pyarrow")
+    else:
+        monkeypatch.setitem(sys.modules, "pyarrow", None)
+        monkeypatch.setitem(sys.modules, "pyarrow.csv", None)
+    return request.param
+
+
+@pytest.mark.parametrize("filepath", ["datasets/MobileNet_results.csv", "datasets/VGG19_results.csv"])
+def test_df_to_html_matches_pandas_for_datasets(filepath):
+    df = pd.read_csv(filepath, index_col=0)
+    assert autoreporting.df_to_html(df, table_id="model") == df.to_html(table_id="model")
+
+
+@pytest.mark.parametrize("df", [
+    pd.DataFrame({"text": ["x&y", "<b>", " padded "], "number": [1, -2, 3], "correct": [True, False, True]},
+                 index=["a.jpg", "b&c.jpg", "<d>.jpg"]),
+    pd.DataFrame({"text": ["x&y", "<b>"]}),
+    pd.DataFrame({"a\tb": ["a\nb", " tab\t", "\r\n", "\t lead"]},
+                 index=pd.Index(["x\ny", "z", "\tw", "v "], name="name\t&")),
+    pd.DataFrame({"score": [0.1, 1 / 3, np.nan, 1e20]}),
+    pd.DataFrame({"text": ["a", None, "c"], "number": [1.0, np.nan, 3.0]}),
+    pd.DataFrame({"correct": [True, None, False]}),
+    pd.DataFrame({"text": ["a", "b"]}, index=pd.Index(["x", "y"], name="image")),
+    pd.DataFrame({"number": pd.Series([], dtype="int64")}),
+    pd.DataFrame({"number": pd.array([1, None, 3], dtype="Int64"),
+                  "correct": pd.array([True, None, False], dtype="boolean")}),
+    pd.DataFrame({"number": [1, 2, 3]}, index=pd.Index([0.5, np.nan, 1 / 3], name="score")),
+])
+def test_df_to_html_matches_pandas(df):
+    assert autoreporting.df_to_html(df, table_id="model") == df.to_html(table_id="model")
+
+
+def test_iter_df_as_html_chunks_tables_with_float_columns():
+    df = pd.DataFrame({"score": np.linspace(0, 1, 12), "correct": [True, False] * 6, "note": ["a", None] * 6})
+    chunks = list(autoreporting.iter_df_as_html(df, table_id="model", chunk_size=2))
+    assert len(chunks) == 8
+    assert "".join(chunks) == df.to_html(table_id="model")
+
+
+def test_iter_df_as_html_chunks_join_to_whole_table():
+    df = pd.read_csv("datasets/VGG19_results.csv", index_col=0)
+    chunks = list(autoreporting.iter_df_as_html(df, table_id="model", chunk_size=7))
+    assert len(chunks) > 3
+    assert "".join(chunks) == df.to_html(table_id="model")
+
+
+def test_corrupt_caches_are_treated_as_missing(tmp_path):
+    filepath = copy_dataset("VGG19_results.csv", tmp_path)
+    for cache_filepath in (filepath + ".pkl", filepath + ".stats.pkl"):
+        with open(cache_filepath, "wb") as f:
+            f.write(b"\x80\x04truncated")
+
+    model_results = autoreporting.ModelResults("VGG19", filepath)
+    assert model_results.number_of_images == 100
+    assert model_results.get_results_df_as_html() == pd.read_csv(filepath, index_col=0).to_html(table_id="VGG19")
+    # The corrupt caches are replaced with readable ones
+    signature = autoreporting.get_file_signature(filepath)
+    assert autoreporting.read_cache(filepath + ".stats.pkl", signature) is not None
+    assert autoreporting.read_cache(filepath + ".pkl", signature) is not None
+
+
+def test_caches_are_not_used_for_a_replacement_with_an_older_mtime(tmp_path):
+    filepath = str(tmp_path / "X_results.csv")
+    replacement_filepath = str(tmp_path / "replacement.csv")
+    with open(filepath, "w") as f:
+        f.write(",correct\na.jpg,True\nb.jpg,True\n")
+    with open(replacement_filepath, "w") as f:
+        f.write(",correct\na.jpg,True\nb.jpg,False\n")
+    hour_ago = os.path.getmtime(filepath) - 3600
+    os.utime(replacement_filepath, (hour_ago, hour_ago))
+    assert autoreporting.ModelResults("X", filepath).accuracy == 1
+
+    os.replace(replacement_filepath, filepath)
+    model_results = autoreporting.ModelResults("X", filepath)
+    assert model_results.accuracy == 0.5
+    assert "False" in model_results.get_results_df_as_html()
+
+
+def test_results_written_by_to_csv_are_read(tmp_path, csv_engine):
+    filepath = str(tmp_path / "plain_results.csv")
+    df = pd.DataFrame(
+        {"imagenet_category": ["tabby", None, "x&y"], "imagenet_index": [281, np.nan, 158],
+         "correct": [True, False, False]},
+        index=["a.jpg", "b.jpg", "c.jpg"])
+    df.to_csv(filepath)
+
+    model_results = autoreporting.ModelResults("plain", filepath)
+    assert model_results.number_of_images == 3
+    assert model_results.misidentified_images_list == ["b.jpg", "c.jpg"]
+    expected_html = pd.read_csv(filepath, index_col=0, engine="c").to_html(table_id="plain")
+    assert model_results.get_results_df_as_html() == expected_html
+
+
+def test_stale_precompiled_templates_are_ignored(tmp_path):
+    source_path = tmp_path / "templates"
+    source_path.mkdir()
+    source_filepath = source_path / "page.html"
+    source_filepath.write_text("old")
+    compiled_path = str(tmp_path / "templates_compiled")
+    Environment(loader=FileSystemLoader(str(source_path))).compile_templates(compiled_path, zip=None)
+
+    def render():
+        env = Environment(loader=ChoiceLoader([
+            autoreporting.PrecompiledLoader(compiled_path, source_path=str(source_path)),
+            FileSystemLoader(str(source_path))
+        ]))
+        return env.get_template("page.html").render()
+
+    # The compiled template is used while it is at least as new as its source
+    source_filepath.write_text("new")
+    compiled_filename = autoreporting.PrecompiledLoader.get_module_filename("page.html")
+    compiled_mtime = os.path.getmtime(os.path.join(compiled_path, compiled_filename))
+    os.utime(source_filepath, (compiled_mtime - 10, compiled_mtime - 10))
+    assert render() == "old"
+
+    os.utime(source_filepath, (compiled_mtime + 10, compiled_mtime + 10))
+    assert render() == "new"
+
+
+def test_common_misidentified_images_for_one_model_is_a_copy(tmp_path):
+    model_results = autoreporting.ModelResults("VGG19", copy_dataset("VGG19_results.csv", tmp_path))
+    common_images = autoreporting.common_misidentified_images([model_results])
+    assert common_images.tolist() == model_results.misidentified_images_list
+    common_images[0] = "changed.jpg"
+    assert model_results.misidentified_images[0] != "changed.jpg"
+
+
+@pytest.fixture
+def report_folder(tmp_path, monkeypatch):
+    """
+    Run from a folder laid out like the repository, with its own templates, datasets and outputs.
+    """
+    for folder in ("templates", "datasets"):
+        (tmp_path / folder).mkdir()
+        for name in os.listdir(folder):
+            with open(os.path.join(folder, name), "rb") as source:
+                (tmp_path / folder / name).write_bytes(source.read())
+    (tmp_path / "outputs").mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_interrupted_report_is_not_up_to_date(report_folder, monkeypatch):
+    results_filepaths = ["datasets/MobileNet_results.csv", "datasets/VGG19_results.csv"]
+    monkeypatch.setattr("sys.argv", ["autoreporting.py"] + results_filepaths)
+    autoreporting.main()
+    assert autoreporting.is_report_up_to_date("outputs/report.html", results_filepaths)
+    complete_report = (report_folder / "outputs" / "report.html").read_bytes()
+
+    def interrupted(self, chunk_size=autoreporting.HTML_CHUNK_SIZE):
+        yield "<table>"
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(autoreporting.ModelResults, "iter_results_df_as_html", interrupted)
+    monkeypatch.setattr("sys.argv", ["autoreporting.py", "--force"] + results_filepaths)
+    with pytest.raises(KeyboardInterrupt):
+        autoreporting.main()
+
+    assert (report_folder / "outputs" / "report.html").read_bytes() == complete_report
+    assert not (report_folder / "outputs" / "report.html.tmp").exists()
+    assert not autoreporting.is_report_up_to_date("outputs/report.html", results_filepaths)
+
+
+def test_report_is_out_of_date_after_templates_are_compiled(report_folder, monkeypatch):
+    results_filepaths = ["datasets/VGG19_results.csv"]
+    monkeypatch.setattr("sys.argv", ["autoreporting.py"] + results_filepaths)
+    autoreporting.main()
+    assert autoreporting.is_report_up_to_date("outputs/report.html", results_filepaths)
+
+    Environment(loader=FileSystemLoader("templates")).compile_templates("templates_compiled", zip=None)
+    later = os.path.getmtime("outputs/report.html") + 10
+    for name in os.listdir("templates_compiled"):
+        os.utime(os.path.join("templates_compiled", name), (later, later))
+    assert not autoreporting.is_report_up_to_date("outputs/report.html", results_filepaths)
+
+
+def test_blank_correct_cell_is_neither_correct_nor_misidentified(tmp_path, csv_engine):
+    filepath = str(tmp_path / "blank_results.csv")
+    with open(filepath, "w") as f:
+        f.write(",imagenet_index,imagenet_category,correct\na.jpg,1,tabby,True\nb.jpg,,,\nc.jpg,3,x&y,False\n")
+
+    model_results = autoreporting.ModelResults("blank", filepath)
+    assert model_results.number_of_images == 3
+    assert model_results.accuracy == 1 / 3
+    assert model_results.misidentified_images_list == ["c.jpg"]
+    assert model_results.number_misidentified == 1
+    expected_html = pd.read_csv(filepath, index_col=0, engine="c").to_html(table_id="blank")
+    assert model_results.get_results_df_as_html() == expected_html